@@ -1,9 +1,16 @@
 from dataclasses import dataclass
+from functools import cache
 from typing import Self
 
 
-@dataclass
+@dataclass(slots=True)
 class Data:
     @classmethod
     def create(cls, **kwargs) -> Self:
-        return cls(**{k: kwargs[k] for k in kwargs if k in cls.__match_args__})
+        field_names = cls.field_names()
+        return cls(**{k: v for k, v in kwargs.items() if k in field_names})
+
+    @classmethod
+    @cache
+    def field_names(cls) -> frozenset[str]:
+        return frozenset(cls.__match_args__)
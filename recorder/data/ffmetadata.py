@@ -1,21 +1,34 @@
-import datetime
+import bisect
 import logging
 import math
+import os
 import json
-from dataclasses import asdict, dataclass, field
-from typing import Any, Optional, Self
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Iterator, Optional, Self
 from pathlib import Path
 
 from recorder.data.data import Data
 
+ESCAPE_TABLE = str.maketrans({"=": "\\=", ";": "\\;", "#": "\\#", "\\": "\\\\", "\n": "\\\n"})
+CHAPTER_TEMPLATE = "\n[CHAPTER]\nTIMEBASE=1/1000\nSTART={start}\nEND={end}\ntitle={title}\n"
 
-@dataclass
+
+@dataclass(slots=True)
 class FFChapter(Data):
     title: str
     time: float
 
 
-@dataclass
+_END_SENTINEL = FFChapter(title="end", time=math.inf)
+
+
+@lru_cache(maxsize=512)
+def _escape(s: str) -> str:
+    return s.translate(ESCAPE_TABLE)
+
+
+@dataclass(slots=True)
 class FFMetadata(Data):
     id: Optional[str] = field(default=None)
     title: Optional[str] = field(default=None)
@@ -29,84 +42,129 @@ class FFMetadata(Data):
 
     @classmethod
     def create(cls, **kwargs) -> Self:
+        field_names = cls.field_names()
         new_kwargs: dict[str, Any] = {}
         for k, v in kwargs.items():
             if k in ("categories", "titles"):
-                new_kwargs[k] = [FFChapter.create(**item) for item in v]
-            elif k in cls.__match_args__:
+                # chapters are stored as [title, time] pairs, older files use objects
+                new_kwargs[k] = [
+                    FFChapter(title=item["title"], time=item["time"]) if isinstance(item, dict) else FFChapter(*item) for item in v
+                ]
+            elif k in field_names:
                 new_kwargs[k] = v
         return cls(**new_kwargs)
 
     def append_ffmetadata(self, path: Path) -> None:
         logging.debug("writing metadata to %s", path)
 
-        with open(path, 'a') as f:
-            # Write basic metadata
-            if self.title is not None:
-                f.write(f"title={self.escape(self.title)}\n")
-            if self.author is not None:
-                f.write(f"author={self.escape(self.author)}\n")
-
-            # Build description
-            description = ""
-            if self.description is not None:
-                description += self.description
-            if self.id is not None:
-                description += f"\nID: {self.id}"
-
-            # Add category and title changes
-            if self.start_time is not None:
-                if len(self.categories) > 0:
-                    description += "\nCategories:"
-                chapters = [*self.categories, FFChapter(title="end", time=float("inf"))]
-                for i in range(len(chapters[:-1])):
-                    if chapters[i+1].time <= self.start_time:
+        with open(path, "a", buffering=1 << 20) as f:
+            f.write(self.ffmetadata())
+
+    def ffmetadata(self) -> str:
+        parts: list[str] = []
+        app = parts.append
+
+        # Write basic metadata
+        if self.title is not None:
+            app(f"title={_escape(self.title)}\n")
+        if self.author is not None:
+            app(f"author={_escape(self.author)}\n")
+
+        # Build description
+        desc_parts: list[str] = []
+        if self.description is not None:
+            desc_parts.append(self.description)
+        if self.id is not None:
+            desc_parts.append(f"\nID: {self.id}")
+
+        # Add category and title changes
+        if self.start_time is not None:
+            start = self.start_time
+            for header, changes in (("Categories", self.categories), ("Titles", self.titles)):
+                if len(changes) > 0:
+                    desc_parts.append(f"\n{header}:")
+                for chapter, next_chapter in self._chapter_spans(changes, _END_SENTINEL, start):
+                    if next_chapter.time <= start:
                         continue
-                    description += f"\n{datetime.timedelta(seconds=round(max(chapters[i].time - self.start_time, 0)))}: {chapters[i].title}"
+                    desc_parts.append(f"\n{self.timestamp(chapter.time - start)}: {chapter.title}")
+        description = "".join(desc_parts)
+
+        # Write description
+        if len(description) > 0:
+            # the description is unique per video, so skip the escape cache
+            app(f"description={description.translate(ESCAPE_TABLE)}\n")
+
+        # Write chapters based on category changes
+        if self.start_time is not None and self.end_time is not None:
+            t_start = math.floor(1000 * self.start_time)
+            t_curr = t_start
+            for chapter, next_chapter in self._chapter_spans(self.categories, FFChapter(title="end", time=self.end_time), self.start_time):
+                t_next = math.floor(1000 * next_chapter.time)
+                if t_next <= t_start:
+                    continue
+                app(CHAPTER_TEMPLATE.format(start=t_curr - t_start, end=t_next - t_start, title=_escape(chapter.title)))
+                t_curr = t_next
+
+        return "".join(parts)
 
-                if len(self.titles) > 0:
-                    description += "\nTitles:"
-                chapters = [*self.titles, FFChapter(title="end", time=float("inf"))]
-                for i in range(len(chapters[:-1])):
-                    if chapters[i+1].time <= self.start_time:
-                        continue
-                    description += f"\n{datetime.timedelta(seconds=round(max(chapters[i].time - self.start_time, 0)))}: {chapters[i].title}"
-
-            # Write description
-            if len(description) > 0:
-                f.write(f"description={self.escape(description)}\n")
-
-            # Write chapters based on category changes
-            if self.start_time is not None and self.end_time is not None:
-                t_start = math.floor(1000 * self.start_time)
-                t_curr = t_start
-                chapters = [*self.categories, FFChapter(title="end", time=self.end_time)]
-                for i in range(len(chapters[:-1])):
-                    t_next = math.floor(1000 * chapters[i+1].time)
-                    if t_next <= t_start:
-                        continue
-                    f.write("\n".join([
-                        "",
-                        "[CHAPTER]",
-                        "TIMEBASE=1/1000",
-                        f"START={t_curr - t_start}",
-                        f"END={t_next - t_start}",
-                        f"title={self.escape(chapters[i].title)}",
-                        ""
-                    ]))
-                    t_curr = t_next
+    @staticmethod
+    def timestamp(seconds: float) -> str:
+        minutes, secs = divmod(round(max(seconds, 0)), 60)
+        hours, minutes = divmod(minutes, 60)
+        return f"{hours}:{minutes:02d}:{secs:02d}"
+
+    @staticmethod
+    def _chapter_spans(chapters: list[FFChapter], end: FFChapter, start_time: float) -> Iterator[tuple[FFChapter, FFChapter]]:
+        # chapters are recorded in time order, so jump straight to the one in progress at start_time
+        first = max(bisect.bisect_right(chapters, start_time, key=lambda c: c.time) - 1, 0)
+        for i in range(first, len(chapters) - 1):
+            yield chapters[i], chapters[i + 1]
+        if chapters:
+            yield chapters[-1], end
+
+    def replay_events(self, path: Path) -> None:
+        with open(path, "r") as f:
+            for line in f:
+                event = json.loads(line)
+                chapter = FFChapter(title=event["title"], time=event["time"])
+                match event["kind"]:
+                    case "categories":
+                        self.categories.append(chapter)
+                    case "titles":
+                        self.titles.append(chapter)
+
+    @staticmethod
+    def append_events(path: Path, events: list[tuple[str, FFChapter]]) -> None:
+        with open(path, "a") as f:
+            f.write("".join(json.dumps({"kind": kind, "title": c.title, "time": c.time}) + "\n" for kind, c in events))
+
+    @staticmethod
+    def ffmetadata_header(tags: dict[str, str]) -> str:
+        return ";FFMETADATA1\n" + "".join(f"{_escape(k)}={_escape(v)}\n" for k, v in tags.items())
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "id": self.id,
+            "title": self.title,
+            "author": self.author,
+            "description": self.description,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "categories": [(c.title, c.time) for c in self.categories],
+            "titles": [(c.title, c.time) for c in self.titles],
+        }
 
     @staticmethod
     def dump(obj: "FFMetadata", path: Path) -> None:
-        with open(path, "w") as f:
-            json.dump(asdict(obj), f, indent=4)
+        # write to a temp file first so a crash mid-write can't corrupt the sidecar
+        tmp_path = path.with_suffix(f"{path.suffix}.tmp")
+        tmp_path.write_text(json.dumps(obj.to_dict(), indent=4))
+        os.replace(tmp_path, path)
 
     @staticmethod
     def load(path: Path) -> "FFMetadata":
-        with open(path, "r") as f:
-            data = json.load(f)
-            return FFMetadata.create(**data)
+        return FFMetadata.create(**json.loads(path.read_bytes()))
 
     @staticmethod
     def escape(s: str) -> str:
-        return "".join(f"\\{x}" if x in ["=", ";", "#", "\\", "\n"] else x for x in s)
+        return _escape(s)
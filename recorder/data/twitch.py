@@ -5,7 +5,7 @@ from typing import Any, Self
 from recorder.data.data import Data
 
 
-@dataclass
+@dataclass(slots=True)
 class Stream(Data):
     id: str = field(default="")
     title: str = field(default="")
@@ -17,21 +17,22 @@ class Stream(Data):
 
     @classmethod
     def create(cls, **kwargs) -> Self:
+        field_names = cls.field_names()
         new_kwargs: dict[str, Any] = {}
         for k, v in kwargs.items():
             if k == "started_at":
                 new_kwargs[k] = datetime.fromisoformat(v)
-            elif k in cls.__match_args__:
+            elif k in field_names:
                 new_kwargs[k] = v
         return cls(**new_kwargs)
 
 
-@dataclass
+@dataclass(slots=True)
 class StreamPaginator(Data):
     cursor: str = field(default="")
 
 
-@dataclass
+@dataclass(slots=True)
 class StreamResponse(Data):
     data: list[Stream] = field(default_factory=list)
     pagination: StreamPaginator = field(default_factory=StreamPaginator)
@@ -46,6 +47,7 @@ class StreamResponse(Data):
         return cls(**new_kwargs)
 
 
-@dataclass
+@dataclass(slots=True)
 class OAuthToken(Data):
     access_token: str
+    expires_in: int = field(default=0)
@@ -1,3 +1,4 @@
+import json
 import subprocess
 from pathlib import Path
 
@@ -10,16 +11,13 @@ class FFMpegRecorder:
     """
 
     @staticmethod
-    def get_video_metadata(video_src_path: Path, metadata_dst_path: Path) -> None:
-        subprocess.run([config.ffmpeg, "-v", "error", "-i", video_src_path, "-f", "ffmetadata", metadata_dst_path], check=True)
+    def probe(video_src_path: Path) -> tuple[float, dict[str, str]]:
+        res = subprocess.run([config.ffprobe, "-v", "error", "-i", video_src_path, "-show_entries", "format=duration:format_tags",
+                              "-of", "json"], check=True, stdout=subprocess.PIPE)
+        info = json.loads(res.stdout)["format"]
+        return float(info["duration"]), info.get("tags", {})
 
     @staticmethod
-    def get_video_length(video_src_path: Path) -> float:
-        res = subprocess.run([config.ffprobe, "-v", "error", "-i", video_src_path, "-show_entries", "format=duration",
-                              "-of", "default=noprint_wrappers=1:nokey=1"], check=True, capture_output=True)
-        return float(res.stdout.strip())
-
-    @staticmethod
-    def process_video(video_src_path: Path, metadata_src_path: Path, video_dst_path: Path) -> None:
-        subprocess.run([config.ffmpeg, "-v", "error", "-i", video_src_path,  "-i", metadata_src_path,
-                        "-map_metadata", "1", "-c", "copy", video_dst_path], check=True)
+    def process_video(video_src_path: Path, ffmetadata: str, video_dst_path: Path) -> None:
+        subprocess.run([config.ffmpeg, "-v", "error", "-i", video_src_path, "-f", "ffmetadata", "-i", "pipe:0",
+                        "-map_metadata", "1", "-c", "copy", video_dst_path], input=ffmetadata.encode(), check=True)
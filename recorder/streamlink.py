@@ -1,4 +1,9 @@
-import subprocess
+import asyncio
+import logging
+import os
+import signal
+import sys
+import time
 from pathlib import Path
 
 import config
@@ -10,10 +15,69 @@ class Streamlink:
     """
 
     quality = "best"
+    stall_check_interval = 30
+    stop_timeout = 10
 
     @staticmethod
-    def record_stream(username: str, video_dst_path: Path) -> None:
+    async def record_stream(username: str, video_dst_path: Path, stall_timeout: float) -> None:
         options = ["--twitch-disable-ads"]
         if config.oauth_token != "":
             options.append(f"--twitch-api-header=Authorization=OAuth {config.oauth_token}")
-        subprocess.run([config.streamlink, *options, "--output", video_dst_path, f"twitch.tv/{username}", Streamlink.quality])
+        proc = await asyncio.create_subprocess_exec(
+            config.streamlink, *options, "--output", video_dst_path, f"twitch.tv/{username}", Streamlink.quality,
+            start_new_session=True)
+        watchdog = asyncio.create_task(Streamlink.watch_output(proc, video_dst_path, stall_timeout))
+        try:
+            await proc.wait()
+        finally:
+            watchdog.cancel()
+            if proc.returncode is None:
+                # streamlink runs in its own session, so it doesn't see a ctrl+c sent to the recorder
+                Streamlink.terminate(proc, signal.SIGINT)
+                await Streamlink.wait_or_kill(proc)
+
+    @staticmethod
+    async def watch_output(proc: asyncio.subprocess.Process, video_dst_path: Path, stall_timeout: float) -> None:
+        last_size = -1
+        last_change = time.monotonic()
+        while True:
+            await asyncio.sleep(Streamlink.stall_check_interval)
+            try:
+                size = video_dst_path.stat().st_size
+            except FileNotFoundError:
+                size = 0
+            if size != last_size:
+                last_size = size
+                last_change = time.monotonic()
+            elif time.monotonic() - last_change >= stall_timeout:
+                logging.warning("no output from streamlink for %d seconds, stopping it", stall_timeout)
+                Streamlink.terminate(proc, signal.SIGTERM)
+                await Streamlink.wait_or_kill(proc)
+                return
+
+    @staticmethod
+    async def wait_or_kill(proc: asyncio.subprocess.Process) -> None:
+        """
+        Give streamlink time to finish writing the recording, then kill it.
+        """
+        try:
+            await asyncio.wait_for(proc.wait(), Streamlink.stop_timeout)
+        except TimeoutError:
+            logging.warning("streamlink did not stop, killing it")
+            Streamlink.terminate(proc, None)
+            await proc.wait()
+
+    @staticmethod
+    def terminate(proc: asyncio.subprocess.Process, sig: signal.Signals | None) -> None:
+        """
+        Send sig to the streamlink process group, or kill it if sig is None.
+        """
+        if proc.returncode is not None:
+            return
+        try:
+            if sys.platform == "win32":
+                proc.kill()
+            else:
+                os.killpg(proc.pid, signal.SIGKILL if sig is None else sig)
+        except ProcessLookupError:
+            pass
@@ -0,0 +1,14 @@
+import importlib.machinery
+import importlib.util
+import sys
+from pathlib import Path
+
+# the recorder modules import the user's config.py, fall back to the template when it hasn't been created
+try:
+    import config  # noqa: F401
+except ImportError:
+    loader = importlib.machinery.SourceFileLoader("config", str(Path(__file__).parents[1].joinpath("config.py.template")))
+    spec = importlib.util.spec_from_loader("config", loader)
+    assert spec is not None
+    sys.modules["config"] = importlib.util.module_from_spec(spec)
+    loader.exec_module(sys.modules["config"])
@@ -147,6 +147,29 @@ class TestFFMetadata():
                 "title=Game B",
                 "",
             ])
+        ),
+        Case(
+            id="all before start time",
+            metadata=FFMetadata(
+                title="Merry Christmas!", author="batatvideogames", id="40000000000",
+                description="Streamed on 2023-12-25 00:00:00 UTC at twitch.tv/batatvideogames", start_time=1000, end_time=2000,
+                categories=[FFChapter(title="Game A", time=100), FFChapter(title="Game B", time=200), FFChapter(title="Game C", time=300)]
+            ),
+            expected="\n".join([
+                "title=Merry Christmas!",
+                "author=batatvideogames",
+                "description=Streamed on 2023-12-25 00:00:00 UTC at twitch.tv/batatvideogames\\",
+                "ID: 40000000000\\",
+                "Categories:\\",
+                "0:00:00: Game C",
+                "",
+                "[CHAPTER]",
+                "TIMEBASE=1/1000",
+                "START=0",
+                "END=1000000",
+                "title=Game C",
+                "",
+            ])
         )
     ]
 
@@ -157,3 +180,52 @@ class TestFFMetadata():
         metadata.append_ffmetadata(tmp_file)
         with open(tmp_file, "r") as f:
             assert f.read() == expected
+
+    @pytest.mark.parametrize("s,expected", [
+        ("Just Chatting", "Just Chatting"),
+        ("a=b;c#d", "a\\=b\\;c\\#d"),
+        ("C:\\bin\nnext", "C:\\\\bin\\\nnext"),
+    ])
+    def test_ffmetadata_escape(self, s: str, expected: str) -> None:
+        assert FFMetadata.escape(s) == expected
+
+    def test_ffmetadata_replay_events(self, tmp_path: Path) -> None:
+        tmp_file = tmp_path.joinpath("test.jsonl")
+        FFMetadata.append_events(tmp_file, [
+            ("categories", FFChapter(title="Just Chatting", time=1000)),
+            ("titles", FFChapter(title="Merry Christmas!", time=1000)),
+        ])
+        FFMetadata.append_events(tmp_file, [("categories", FFChapter(title="Super Mario 64", time=1500))])
+
+        metadata = FFMetadata(title="Merry Christmas!", categories=[FFChapter(title="Game A", time=900)])
+        metadata.replay_events(tmp_file)
+        assert metadata.categories == [
+            FFChapter(title="Game A", time=900),
+            FFChapter(title="Just Chatting", time=1000),
+            FFChapter(title="Super Mario 64", time=1500),
+        ]
+        assert metadata.titles == [FFChapter(title="Merry Christmas!", time=1000)]
+
+    def test_ffmetadata_dump_load(self, tmp_path: Path) -> None:
+        tmp_file = tmp_path.joinpath("test.json")
+        metadata = FFMetadata(
+            title="Merry Christmas!", author="batatvideogames", id="40000000000", start_time=1000, end_time=2000,
+            categories=[FFChapter(title="Game A", time=900), FFChapter(title="Game B", time=1100)],
+            titles=[FFChapter(title="Merry Christmas!", time=900)]
+        )
+        FFMetadata.dump(metadata, tmp_file)
+        assert FFMetadata.load(tmp_file) == metadata
+
+    def test_ffmetadata_load_chapter_objects(self, tmp_path: Path) -> None:
+        tmp_file = tmp_path.joinpath("test.json")
+        tmp_file.write_text('{"title": "Merry Christmas!", "categories": [{"title": "Game A", "time": 900}], "titles": []}')
+        assert FFMetadata.load(tmp_file) == FFMetadata(title="Merry Christmas!", categories=[FFChapter(title="Game A", time=900)])
+
+    @pytest.mark.parametrize("seconds,expected", [
+        (0, "0:00:00"),
+        (-100, "0:00:00"),
+        (3479.6, "0:58:00"),
+        (90061, "25:01:01"),
+    ])
+    def test_ffmetadata_timestamp(self, seconds: float, expected: str) -> None:
+        assert FFMetadata.timestamp(seconds) == expected
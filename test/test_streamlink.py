@@ -0,0 +1,54 @@
+import asyncio
+import pytest
+import signal
+import sys
+from pathlib import Path
+
+from recorder.streamlink import Streamlink
+
+pytestmark = pytest.mark.skipif(sys.platform == "win32", reason="streamlink is stopped through its process group")
+
+# stands in for streamlink, appending to the output file a number of times before going quiet
+FAKE_STREAMLINK = """
+import signal, sys, time
+if sys.argv[3] == "ignore-sigterm":
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+print("started", flush=True)
+with open(sys.argv[1], "ab") as f:
+    for _ in range(int(sys.argv[2])):
+        f.write(b"x" * 1024)
+        f.flush()
+        time.sleep(0.05)
+time.sleep(60)
+"""
+
+
+class TestStreamlink():
+    @pytest.fixture(autouse=True)
+    def fast_watchdog(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        monkeypatch.setattr(Streamlink, "stall_check_interval", 0.1)
+        monkeypatch.setattr(Streamlink, "stop_timeout", 0.5)
+
+    async def watch(self, video_path: Path, writes: int, on_sigterm: str) -> int | None:
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, "-c", FAKE_STREAMLINK, str(video_path), str(writes), on_sigterm,
+            stdout=asyncio.subprocess.PIPE, start_new_session=True)
+        try:
+            assert proc.stdout is not None
+            await asyncio.wait_for(proc.stdout.readline(), 10)
+            await asyncio.wait_for(Streamlink.watch_output(proc, video_path, stall_timeout=0.3), 10)
+        finally:
+            Streamlink.terminate(proc, None)
+            await proc.wait()
+        return proc.returncode
+
+    @pytest.mark.parametrize("writes,on_sigterm,expected", [
+        (0, "exit", -signal.SIGTERM),
+        (10, "exit", -signal.SIGTERM),
+        (0, "ignore-sigterm", -signal.SIGKILL),
+    ])
+    def test_watch_output_stops_stalled_streamlink(self, tmp_path: Path, writes: int, on_sigterm: str, expected: int) -> None:
+        video_path = tmp_path.joinpath("test.mp4")
+        assert asyncio.run(self.watch(video_path, writes, on_sigterm)) == expected
+        # not stopped while the output was still growing
+        assert (video_path.stat().st_size if video_path.exists() else 0) == writes * 1024
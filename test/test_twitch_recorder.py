@@ -0,0 +1,41 @@
+import importlib.util
+import pytest
+import sys
+from pathlib import Path
+from typing import Any
+
+from recorder.data.twitch import OAuthToken
+
+# the entry point script isn't an importable module name, so load it from its path
+spec = importlib.util.spec_from_file_location("twitch_recorder", Path(__file__).parents[1].joinpath("twitch-recorder.py"))
+assert spec is not None and spec.loader is not None
+twitch_recorder = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(twitch_recorder)
+
+
+class TestTwitchRecorder():
+    @pytest.fixture
+    def recorder(self, tmp_path: Path) -> Any:
+        recorder = twitch_recorder.TwitchRecorder()
+        recorder.client_id = "client"
+        recorder.token_path = tmp_path.joinpath(".twitch_token.json")
+        return recorder
+
+    @pytest.mark.parametrize("expires_in,client_id,expected", [
+        (3600, "client", "token"),
+        (200, "client", ""),
+        (3600, "other client", ""),
+    ])
+    def test_access_token_cache(self, recorder: Any, expires_in: int, client_id: str, expected: str) -> None:
+        recorder.save_access_token(OAuthToken(access_token="token", expires_in=expires_in))
+        recorder.client_id = client_id
+        assert recorder.load_access_token() == expected
+
+    def test_access_token_cache_missing(self, recorder: Any) -> None:
+        assert recorder.load_access_token() == ""
+
+    @pytest.mark.skipif(sys.platform == "win32", reason="posix file permissions")
+    def test_access_token_cache_permissions(self, recorder: Any) -> None:
+        recorder.save_access_token(OAuthToken(access_token="token", expires_in=3600))
+        assert recorder.token_path.stat().st_mode & 0o777 == 0o600
+        assert list(recorder.token_path.parent.iterdir()) == [recorder.token_path]
@@ -1,13 +1,19 @@
 import asyncio
+import atexit
 import enum
-import functools
 import getopt
+import json
 import logging
+import logging.handlers
 import multiprocessing as mp
+import os
 import requests
 import shutil
+import signal
 import sys
+import tempfile
 import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timezone
 from pathlib import Path
 from requests.adapters import HTTPAdapter, Retry
@@ -17,7 +23,6 @@ from recorder.data.ffmetadata import FFMetadata, FFChapter
 from recorder.data.twitch import Stream, StreamResponse, OAuthToken
 from recorder.ffmpeg import FFMpegRecorder
 from recorder.streamlink import Streamlink
-from recorder.poller import Poller
 
 
 class TwitchResponseStatus(enum.Enum):
@@ -36,6 +41,7 @@ class TwitchRecorder:
         self.processed_dir = Path(config.storage_dir).joinpath("processed")
         self.stream_poll_interval = 10
         self.metadata_poll_interval = 30
+        self.stream_stall_timeout = 300
 
         # twitch configuration
         self.oauth_url = "https://id.twitch.tv/oauth2/token"
@@ -44,17 +50,70 @@ class TwitchRecorder:
         self.client_secret = config.client_secret
         self.access_token = ""
         self.oauth_token = config.oauth_token
+        self.token_path = Path(config.storage_dir).joinpath(".twitch_token.json")
+        self.stream_url = ""
+        self.token_params = {
+            "client_id": self.client_id,
+            "client_secret": self.client_secret,
+            "grant_type": "client_credentials",
+        }
+
+        # http session, reused so polls keep their connection alive
+        self.session = requests.Session()
+        self.session.headers.update({"Client-ID": self.client_id})
+        self.session.mount(
+            self.api_url,
+            HTTPAdapter(max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504]), pool_maxsize=2),
+        )
+        self.session.mount(
+            self.oauth_url,
+            HTTPAdapter(max_retries=Retry(total=5, backoff_factor=2, backoff_jitter=1, allowed_methods={"POST"})),
+        )
 
-        # state
-        self.recording_lock = mp.Lock()
+        # state, vod processors still running so they can be joined before logging stops
+        self.vod_processors: list[mp.Process] = []
 
-    def fetch_access_token(self) -> str:
-        s = requests.Session()
-        retries = Retry(total=5, backoff_factor=2, backoff_jitter=1, allowed_methods={"POST"})
-        s.mount("https://", HTTPAdapter(max_retries=retries))
+    @property
+    def recording_marker(self) -> Path:
+        # a marker file so vod processors can tell a recording is in progress
+        return self.recorded_dir.joinpath(".recording")
 
-        r = s.post(
-            f"{self.oauth_url}?client_id={self.client_id}&client_secret={self.client_secret}&grant_type=client_credentials",
+    def load_access_token(self) -> str:
+        try:
+            with open(self.token_path, "r") as f:
+                cached = json.load(f)
+            if cached["client_id"] == self.client_id and time.time() + 300 < cached["expires_at"]:
+                return cached["access_token"]
+        except (OSError, ValueError, KeyError) as e:
+            logging.debug("could not read cached access token: %s", e)
+        return ""
+
+    def save_access_token(self, token: OAuthToken) -> None:
+        tmp_path = None
+        try:
+            # recorders share the cache, so write to a unique temp file, mkstemp also makes it owner-only
+            fd, tmp_path = tempfile.mkstemp(prefix=f"{self.token_path.name}.", suffix=".tmp", dir=self.token_path.parent)
+            with open(fd, "w") as f:
+                json.dump({
+                    "client_id": self.client_id,
+                    "access_token": token.access_token,
+                    "expires_at": time.time() + token.expires_in,
+                }, f)
+            os.replace(tmp_path, self.token_path)
+        except OSError as e:
+            logging.warning("could not cache access token: %s", e)
+            if tmp_path is not None:
+                Path(tmp_path).unlink(missing_ok=True)
+
+    def fetch_access_token(self, force: bool = False) -> str:
+        if not force:
+            access_token = self.load_access_token()
+            if access_token != "":
+                return access_token
+
+        r = self.session.post(
+            self.oauth_url,
+            params=self.token_params,
             timeout=15,
         )
         try:
@@ -64,6 +123,7 @@ class TwitchRecorder:
             return self.access_token
 
         token = OAuthToken.create(**r.json())
+        self.save_access_token(token)
         return token.access_token
 
     def fetch_stream(self) -> tuple[TwitchResponseStatus, Stream]:
@@ -71,11 +131,10 @@ class TwitchRecorder:
         status = TwitchResponseStatus.ERROR
         try:
             headers = {
-                "Client-ID": self.client_id,
                 "Authorization": f"Bearer {self.access_token}",
             }
-            r = requests.get(
-                f"{self.api_url}?user_login={self.username}",
+            r = self.session.get(
+                self.stream_url,
                 headers=headers,
                 timeout=15,
             )
@@ -100,152 +159,192 @@ class TwitchRecorder:
             status = TwitchResponseStatus.ERROR
         return status, info
 
-    def process_recorded_vod(self, recorded_video_path: Path, processed_video_path: Path) -> None:
+    @staticmethod
+    def process_recorded_vod(recorded_video_path: Path, processed_video_path: Path) -> None:
         recorded_metadata_path = recorded_video_path.with_suffix(".json")
+        recorded_events_path = recorded_video_path.with_suffix(".jsonl")
         processed_metadata_path = processed_video_path.with_suffix(".json")
 
+        # skip recordings streamlink gave up on before writing any video
+        if recorded_video_path.stat().st_size < 1024:
+            logging.warning("skipping tiny recording %s", recorded_video_path)
+            recorded_video_path.unlink(missing_ok=True)
+            recorded_metadata_path.unlink(missing_ok=True)
+            recorded_events_path.unlink(missing_ok=True)
+            return
+
         # unlink processed files if needed
         processed_video_path.unlink(missing_ok=True)
         processed_metadata_path.unlink(missing_ok=True)
 
-        # use ffmpeg to extract the metadata from the recorded video
-        logging.info("extracting ffmetadata from %s", recorded_video_path)
-        FFMpegRecorder.get_video_metadata(recorded_video_path, processed_metadata_path)
-
-        # get the video length
+        # probe the recorded video for its length and container tags
         logging.info("getting video info from %s", recorded_video_path)
-        video_length = FFMpegRecorder.get_video_length(recorded_video_path)
+        video_length, tags = FFMpegRecorder.probe(recorded_video_path)
 
         # read and update the metadata in the video
         logging.info("extracting metadata from %s", recorded_metadata_path)
         try:
             metadata = FFMetadata.load(recorded_metadata_path)
+            if recorded_events_path.is_file():
+                # apply the metadata changes journaled by the poller during the recording
+                metadata.replay_events(recorded_events_path)
             metadata.end_time = recorded_video_path.stat().st_mtime
             metadata.start_time = metadata.end_time - video_length
         except Exception:
             logging.error("failed to extract video metadata, please fix the file contents and try again")
             raise
 
-        # append the recorded metadata to the extracted metadata
-        logging.info("writing updated metadata to %s", processed_metadata_path)
-        metadata.append_ffmetadata(processed_metadata_path)
-
-        # add the aggregated metadata
+        # remux the video with the container tags followed by the recorded metadata
         logging.info("fixing %s", recorded_video_path)
-        FFMpegRecorder.process_video(recorded_video_path, processed_metadata_path, processed_video_path)
-
-        # copy new metadata to the folder
-        shutil.copy(recorded_metadata_path, processed_metadata_path)
+        FFMpegRecorder.process_video(recorded_video_path, FFMetadata.ffmetadata_header(tags) + metadata.ffmetadata(), processed_video_path)
 
-        # remove temp files
+        # remove temp files, the metadata now lives in the processed video
         recorded_video_path.unlink()
         recorded_metadata_path.unlink()
-        processed_metadata_path.unlink()
+        recorded_events_path.unlink(missing_ok=True)
 
     def process_recorded_vods(self) -> None:
-        if not self.recording_lock.acquire(block=False):
+        TwitchRecorder.reset_signals()
+        if self.recording_marker.exists():
             return
-        self.recording_lock.release()
-
-        videos = [p for p in self.recorded_dir.iterdir() if p.is_file() and p.suffix == ".mp4"]
-        if len(videos) > 0:
-            logging.info("processing previously recorded files")
-        for video_path in videos:
-            recorded_filepath = self.recorded_dir.joinpath(video_path.name)
-            processed_filepath = self.processed_dir.joinpath(video_path.name)
-            try:
-                logging.info("processing %s", video_path)
-                self.process_recorded_vod(recorded_filepath, processed_filepath)
-            except Exception as e:
-                logging.error("skipped processing %s, encountered exception: %s", video_path, e)
-
-    async def poll_metadata(self, metadata: FFMetadata, metadata_path: Path) -> None:
+
+        with os.scandir(self.recorded_dir) as it:
+            videos = [Path(e.path) for e in it if e.name.endswith(".mp4") and e.is_file(follow_symlinks=False)]
+        if len(videos) == 0:
+            return
+        logging.info("processing previously recorded files")
+
+        # each vod is independent, so process them in parallel
+        processed_paths = [self.processed_dir.joinpath(video_path.name) for video_path in videos]
+        max_workers = min(os.cpu_count() or 1, len(videos), 4)
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=TwitchRecorder.lower_priority) as executor:
+            list(executor.map(TwitchRecorder.try_process_recorded_vod, videos, processed_paths))
+
+    def start_vod_processor(self) -> None:
+        vod_processor = mp.Process(target=self.process_recorded_vods)
+        vod_processor.start()
+        self.vod_processors = [p for p in self.vod_processors if p.is_alive()] + [vod_processor]
+
+    @staticmethod
+    def reset_signals() -> None:
+        # vod processors may be forked from inside the event loop, so drop its signal handlers and wakeup fd
+        if sys.platform != "win32":
+            signal.set_wakeup_fd(-1)
+            for sig in (signal.SIGTERM, signal.SIGHUP):
+                signal.signal(sig, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+    @staticmethod
+    def lower_priority() -> None:
+        # ffmpeg inherits the niceness, so background remuxes yield to a live recording
+        if hasattr(os, "nice"):
+            os.nice(10)
+
+    @staticmethod
+    def try_process_recorded_vod(recorded_video_path: Path, processed_video_path: Path) -> None:
+        try:
+            logging.info("processing %s", recorded_video_path)
+            TwitchRecorder.process_recorded_vod(recorded_video_path, processed_video_path)
+        except Exception as e:
+            logging.error("skipped processing %s, encountered exception: %s", recorded_video_path, e)
+
+    async def poll_metadata(self, events_path: Path) -> None:
         prev_stream = Stream()
         while True:
-            status, stream = self.fetch_stream()
+            status, stream = await asyncio.to_thread(self.fetch_stream)
             currtime = time.time()
             match status:
                 case TwitchResponseStatus.UNAUTHORIZED:
                     logging.error("unauthorized, attempting to log back in")
-                    self.access_token = self.fetch_access_token()
+                    self.access_token = await asyncio.to_thread(self.fetch_access_token, True)
+                    await asyncio.sleep(min(5, self.metadata_poll_interval))
                 case TwitchResponseStatus.ONLINE:
+                    events: list[tuple[str, FFChapter]] = []
                     if prev_stream.game_name != stream.game_name:
                         logging.info("setting current game to %s", stream.game_name)
-                        metadata.categories.append(FFChapter(title=stream.game_name, time=currtime))
-                        FFMetadata.dump(metadata, metadata_path)
+                        events.append(("categories", FFChapter(title=stream.game_name, time=currtime)))
                     if prev_stream.title != stream.title:
                         logging.info("setting current stream title to %s", stream.title)
-                        metadata.titles.append(FFChapter(title=stream.title, time=currtime))
-                        FFMetadata.dump(metadata, metadata_path)
+                        events.append(("titles", FFChapter(title=stream.title, time=currtime)))
+                    if events:
+                        FFMetadata.append_events(events_path, events)
                     prev_stream = stream
-                    await asyncio.sleep(0)
+                    await asyncio.sleep(self.metadata_poll_interval)
                 case _:
                     logging.error(
                         "unexpected status %s while polling metadata, retrying in %d seconds",
                         status,
                         self.metadata_poll_interval,
                     )
-                    await asyncio.sleep(0)
-
-    def poll_stream(self) -> None:
-        self.access_token = self.fetch_access_token()
+                    await asyncio.sleep(self.metadata_poll_interval)
+
+    async def record_session(self, stream: Stream) -> None:
+        video_filename = f"{stream.user_login}-{datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S')}-{stream.id}"
+        video_title = stream.title
+        video_author = stream.user_name
+        video_description = f"Streamed on {stream.started_at.strftime('%Y-%m-%d %H:%M:%S %Z')} at twitch.tv/{stream.user_login}"
+
+        recorded_path = self.recorded_dir.joinpath(f"{video_filename}.mp4")
+        metadata_path = recorded_path.with_suffix(".json")
+        events_path = recorded_path.with_suffix(".jsonl")
+
+        # write metadata to file
+        metadata = FFMetadata(
+            title=video_title,
+            author=video_author,
+            description=video_description,
+            id=stream.id,
+        )
+        FFMetadata.dump(metadata, metadata_path)
+
+        # run streamlink, polling for stream metadata on the same event loop
+        logging.info("recording stream to %s", recorded_path)
+        self.recording_marker.touch()
+        poller = asyncio.create_task(self.poll_metadata(events_path))
+        await Streamlink.record_stream(self.username, recorded_path, self.stream_stall_timeout)
+        poller.cancel()
+        for result in await asyncio.gather(poller, return_exceptions=True):
+            if isinstance(result, Exception):
+                logging.error("exception received by metadata poller: %s", result)
+        self.recording_marker.unlink(missing_ok=True)
+
+        # process vods
+        self.start_vod_processor()
+
+    async def poll_stream(self) -> None:
+        # streamlink is in its own session, so stop it through the normal cancellation path on hangup or termination
+        if sys.platform != "win32":
+            loop = asyncio.get_running_loop()
+            task = asyncio.current_task()
+            assert task is not None
+            for sig in (signal.SIGTERM, signal.SIGHUP):
+                loop.add_signal_handler(sig, task.cancel)
+
+        self.access_token = await asyncio.to_thread(self.fetch_access_token)
         while True:
-            status, stream = self.fetch_stream()
+            status, stream = await asyncio.to_thread(self.fetch_stream)
             match status:
                 case TwitchResponseStatus.UNAUTHORIZED:
                     logging.info("unauthorized, attempting to log back in")
-                    self.access_token = self.fetch_access_token()
+                    self.access_token = await asyncio.to_thread(self.fetch_access_token, True)
+                    await asyncio.sleep(min(5, self.stream_poll_interval))
                 case TwitchResponseStatus.OFFLINE:
                     logging.debug(
                         "%s currently offline, checking again in %s seconds",
                         self.username,
                         self.stream_poll_interval,
                     )
-                    time.sleep(self.stream_poll_interval)
+                    await asyncio.sleep(self.stream_poll_interval)
                 case TwitchResponseStatus.ONLINE:
                     logging.info("%s is online, stream recording in session", self.username)
-
-                    video_filename = f"{stream.user_login}-{datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S')}-{stream.id}"
-                    video_title = stream.title
-                    video_author = stream.user_name
-                    video_description = f"Streamed on {stream.started_at.strftime('%Y-%m-%d %H:%M:%S %Z')} at twitch.tv/{stream.user_login}"
-
-                    recorded_path = self.recorded_dir.joinpath(f"{video_filename}.mp4")
-                    metadata_path = self.recorded_dir.joinpath(f"{video_filename}.json")
-
-                    # write metadata to file
-                    metadata = FFMetadata(
-                        title=video_title,
-                        author=video_author,
-                        description=video_description,
-                        id=stream.id,
-                    )
-                    FFMetadata.dump(metadata, metadata_path)
-
-                    # poll for stream metadata on a separate thread
-                    poller = Poller(
-                        target=functools.partial(self.poll_metadata, metadata, metadata_path),
-                        interval=self.metadata_poll_interval,
-                    )
-
-                    # run metadata poller and streamlink
-                    logging.info("recording stream to %s", recorded_path)
-                    self.recording_lock.acquire()
-                    poller.start()
-                    Streamlink.record_stream(self.username, recorded_path)
-                    poller.stop()
-                    self.recording_lock.release()
-
-                    # process vods
-                    vod_processor = mp.Process(target=self.process_recorded_vods)
-                    vod_processor.start()
+                    await self.record_session(stream)
                 case _:
                     logging.error(
                         "unexpected status %s while polling stream, retrying in %d seconds",
                         status,
                         self.stream_poll_interval,
                     )
-                    time.sleep(self.stream_poll_interval)
+                    await asyncio.sleep(self.stream_poll_interval)
 
     def run(self) -> None:
         # setup storage directory
@@ -256,9 +355,14 @@ class TwitchRecorder:
         if not self.processed_dir.is_dir():
             self.processed_dir.mkdir(parents=True, exist_ok=True)
 
+        # nothing is recording yet, so a leftover marker is from a crashed session
+        self.recording_marker.unlink(missing_ok=True)
+
+        # build the stream url once for the session
+        self.stream_url = f"{self.api_url}?user_login={self.username}&first=1"
+
         # fix videos from previous recording session
-        vod_processor = mp.Process(target=self.process_recorded_vods)
-        vod_processor.start()
+        self.start_vod_processor()
 
         # poll for streams
         logging.info(
@@ -267,14 +371,26 @@ class TwitchRecorder:
             self.stream_poll_interval,
             Streamlink.quality,
         )
-        self.poll_stream()
-        vod_processor.join()
+        try:
+            asyncio.run(self.poll_stream())
+        except asyncio.CancelledError:
+            logging.info("termination signal received, exiting")
+        finally:
+            self.session.close()
+            # vod processors log through the main process, so wait for them while it is still listening
+            for vod_processor in self.vod_processors:
+                vod_processor.join()
 
 
 def main(argv) -> int:
     usage_hint = "twitch-recorder.py -u <username> [-l <log level>]"
     logging.basicConfig(level=logging.INFO, handlers=[])
 
+    # the log formats don't use thread or process info, so skip collecting it for every record
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
     try:
         opts, _ = getopt.getopt(argv, "hu:l:", ["help", "username=", "log="])
     except getopt.GetoptError:
@@ -313,12 +429,17 @@ def main(argv) -> int:
     config.logging_dir.mkdir(parents=True, exist_ok=True)
     file_handler = logging.FileHandler(Path(config.logging_dir, f"{twitch_recorder.username}.log"))
     file_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s:%(message)s", datefmt="[%Y-%m-%d %H:%M:%S]"))
-    logging.getLogger().addHandler(file_handler)
     stdout_handler = logging.StreamHandler(sys.stdout)
     stdout_handler.setFormatter(logging.Formatter(fmt="%(asctime)s [%(levelname)s] %(message)s", datefmt="[%Y-%m-%d %H:%M:%S]"))
-    logging.getLogger().addHandler(stdout_handler)
 
-    # run twitch recorder
+    # write records from a background thread, the queue is shared so that vod processors can log too
+    log_queue: mp.Queue = mp.Queue()
+    logging.getLogger().addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, file_handler, stdout_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    # run twitch recorder, run() joins the vod processors before the listener is stopped at exit
     twitch_recorder.run()
     return 0
 